@@ -1,15 +1,24 @@
-import base64
+import asyncio
+import binascii
+import io
 import logging
-import json
 import os
-import requests
+from contextlib import asynccontextmanager
+import httpx
 from dotenv import load_dotenv
 
-from fastapi import FastAPI, Request, HTTPException, Response
+from fastapi import FastAPI, HTTPException, Response, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 import uvicorn
 import openai
+import orjson
+import pybase64
+from PIL import Image, ImageOps
+from cachetools import TTLCache
+from cachetools.keys import hashkey
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
 # --- CONFIGURATION ---
 load_dotenv()
@@ -17,6 +26,11 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GOOGLE_CSE_ID = os.getenv("GOOGLE_CSE_ID")
 APPS_SCRIPT_URL = os.getenv("APPS_SCRIPT_URL")
+MAX_IMAGE_BYTES = 8 * 1024 * 1024
+VISION_MAX_SIDE = 1024
+# Caps in-flight OpenAI calls per worker, so the effective cap is
+# OPENAI_CONCURRENCY x WEB_CONCURRENCY; size it around RPM / 60 / workers.
+OPENAI_SEM = asyncio.Semaphore(int(os.getenv("OPENAI_CONCURRENCY", "40")))
 
 if not OPENAI_API_KEY:
     raise ValueError("No OpenAI API key found.")
@@ -25,16 +39,49 @@ if not GOOGLE_API_KEY or not GOOGLE_CSE_ID:
 if not APPS_SCRIPT_URL:
     raise ValueError("No APPS_SCRIPT_URL found in .env file. Cannot submit data.")
 
-openai.api_key = OPENAI_API_KEY
+# --- Shared Clients ---
+# One OpenAI client and one httpx client per worker, created inside the running
+# event loop and shared by all requests so their connection pools are reused.
+# They are created lazily on first use because not every ASGI host (e.g. the
+# Vercel Python runtime) runs the lifespan startup hook.
+def get_openai_client():
+    if getattr(app.state, "aclient", None) is None:
+        # max_retries=0: create_chat_completion's tenacity retry is the only retry layer.
+        app.state.aclient = openai.AsyncOpenAI(
+            api_key=OPENAI_API_KEY, http_client=openai.DefaultAioHttpClient(), max_retries=0
+        )
+    return app.state.aclient
+
+def get_http_client():
+    if getattr(app.state, "http_client", None) is None:
+        # Shared client for Google Search and Apps Script so connections are kept alive.
+        # Apps Script answers POSTs with a redirect, hence follow_redirects.
+        app.state.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=50, max_connections=200),
+            timeout=30.0,
+            follow_redirects=True,
+        )
+    return app.state.http_client
+
+@asynccontextmanager
+async def lifespan(app):
+    get_openai_client()
+    get_http_client()
+    yield
+    await app.state.aclient.close()
+    await app.state.http_client.aclose()
+    app.state.aclient = app.state.http_client = None
 
 # --- Basic Setup ---
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[logging.StreamHandler()]
 )
 logger = logging.getLogger(__name__)
+# httpx logs full request URLs at INFO (search ID, Apps Script deployment URL).
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # --- CORS Middleware ---
 app.add_middleware(
@@ -60,15 +107,50 @@ class OCRResponse(BaseModel):
     about_the_company: str = Field(default="")
     location: str = Field(default="")
 
-# --- Google Search Function (Unchanged) ---
-def search_google(query, num_results=3):
+# --- OpenAI Call Wrapper ---
+# Throttled by OPENAI_SEM; 429s and the transient errors the SDK would normally
+# retry (connection errors, timeouts, 5xx) are retried here instead, honouring
+# retry-after when present and otherwise using jittered exponential backoff.
+# The client itself never retries, so each attempt is one HTTP request and the
+# semaphore is released while backing off so other requests can proceed.
+RETRYABLE_OPENAI_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+_openai_backoff = wait_random_exponential(multiplier=1, max=20)
+
+def wait_retry_after(retry_state):
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    if response is not None:
+        try:
+            return min(max(float(response.headers.get("retry-after", "")), 0.0), 60.0)
+        except ValueError:
+            pass
+    return _openai_backoff(retry_state)
+
+@retry(
+    retry=retry_if_exception_type(RETRYABLE_OPENAI_ERRORS),
+    wait=wait_retry_after,
+    stop=stop_after_attempt(4),
+    reraise=True,
+)
+async def create_chat_completion(**kwargs):
+    async with OPENAI_SEM:
+        return await get_openai_client().chat.completions.create(**kwargs)
+
+# --- Google Search Function ---
+async def asearch_google(query, num_results=3):
     if not GOOGLE_API_KEY or not GOOGLE_CSE_ID:
         logger.info("Skipping Google search as API keys are not configured.")
         return None
     try:
         url = "https://www.googleapis.com/customsearch/v1"
-        params = {'key': GOOGLE_API_KEY, 'cx': GOOGLE_CSE_ID, 'q': query, 'num': num_results}
-        response = requests.get(url, params=params)
+        # Key goes in a header so it never appears in a logged request URL.
+        headers = {'X-goog-api-key': GOOGLE_API_KEY}
+        params = {'cx': GOOGLE_CSE_ID, 'q': query, 'num': num_results}
+        response = await get_http_client().get(url, params=params, headers=headers)
         response.raise_for_status()
         results = response.json()
         if "items" in results and len(results["items"]) > 0:
@@ -81,11 +163,108 @@ def search_google(query, num_results=3):
         logger.error(f"Error during Google search: {e}", exc_info=True)
         return None
 
-# --- Helper to parse JSON (Unchanged) ---
-def parse_openai_json(response_content):
-    if "```json" in response_content:
-        response_content = response_content.split("```json")[1].split("```")[0].strip()
-    return json.loads(response_content)
+# --- Cached Google Search ---
+# Results are cached for an hour; concurrent identical queries share one in-flight request.
+# Only non-empty results are cached so transient search errors are retried.
+search_cache = TTLCache(maxsize=1024, ttl=3600)
+_inflight_searches = {}
+
+async def _search_and_cache(key, query, num_results):
+    try:
+        results = await asearch_google(query, num_results=num_results)
+        if results:
+            search_cache[key] = results
+        return results
+    finally:
+        _inflight_searches.pop(key, None)
+
+async def cached_search_google(query, num_results=3):
+    key = hashkey(query, num_results)
+    results = search_cache.get(key)
+    if results is not None:
+        logger.info(f"Google search cache hit for: {query}")
+        return results
+    task = _inflight_searches.get(key)
+    if task is None:
+        task = asyncio.create_task(_search_and_cache(key, query, num_results))
+        _inflight_searches[key] = task
+    # Shield so one cancelled caller does not cancel the search for the others.
+    return await asyncio.shield(task)
+
+async def maybe_search_google(query, num_results=3):
+    if not query:
+        return None
+    return await cached_search_google(query, num_results=num_results)
+
+# --- Helpers for base64 image input ---
+def split_image_input(value):
+    # Returns (data_url, raw_base64). An incoming image data URL is reused
+    # verbatim; otherwise data_url is None and is only built if the image is
+    # actually sent unchanged, so multi-MB strings are not copied needlessly.
+    # find + slice avoids the throwaway list and extra copy of split().
+    comma = value.find(',')
+    if comma < 0:
+        return None, value
+    raw_b64 = value[comma + 1:]
+    header = value[:comma]
+    if header.startswith("data:image/") and header.endswith(";base64"):
+        return value, raw_b64
+    return None, raw_b64
+
+def check_image_size(b64_string, label):
+    # Approximate decoded size from the base64 length; no decoding needed.
+    if (len(b64_string) * 3) // 4 > MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail=f"{label} is too large (max {MAX_IMAGE_BYTES // (1024 * 1024)} MB)")
+
+def decode_base64_image(b64_string, label):
+    # Fail fast on malformed input before it reaches OpenAI or Apps Script.
+    try:
+        return pybase64.b64decode(b64_string, validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"{label} is not valid base64: {e}")
+
+def downscale_for_vision(image_bytes, raw_b64, data_url, label):
+    # Returns the data URL for the vision call, shrunk to VISION_MAX_SIDE as JPEG q85;
+    # more pixels only add tiles (tokens) for business-card OCR. Images that are
+    # already small are sent as-is. Apps Script still gets the original.
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            if max(img.size) <= VISION_MAX_SIDE:
+                return data_url or f"data:image/jpeg;base64,{raw_b64}"
+            # Let the JPEG decoder scale down by 1/2..1/8 instead of decoding full resolution.
+            img.draft("RGB", (VISION_MAX_SIDE, VISION_MAX_SIDE))
+            # Resizing drops EXIF, so apply the camera orientation first.
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE))
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            buf = io.BytesIO()
+            img.save(buf, "JPEG", quality=85)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise HTTPException(status_code=400, detail=f"{label} is not a readable image: {e}")
+    return "data:image/jpeg;base64," + pybase64.b64encode(buf.getvalue()).decode("ascii")
+
+def build_contact_query(company):
+    return f'"{company}" about description location contact info email phone address'
+
+# --- Apps Script Submission (runs after the response is sent) ---
+async def _submit_to_apps_script(payload):
+    # Runs as a background task, so failures are logged rather than raised.
+    try:
+        headers = {'Content-Type': 'text/plain;charset=utf-8'}
+        response = await get_http_client().post(
+            APPS_SCRIPT_URL,
+            content=orjson.dumps(payload),
+            headers=headers
+        )
+        response.raise_for_status()
+        save_result = response.json()
+        if not save_result.get("success"):
+            logger.error(f"Google Apps Script failed to save: {save_result.get('message')}")
+            return
+        logger.info("Step 4: Successfully submitted to Google Apps Script.")
+    except Exception as e:
+        logger.error(f"Failed to submit to Google Apps Script: {e}", exc_info=True)
 
 # --- Middleware (Unchanged) ---
 @app.middleware("http")
@@ -105,20 +284,28 @@ def read_root():
     return {"status": "OCR Backend is running"}
 
 @app.post("/ocr", response_model=OCRResponse)
-async def perform_ocr(request_data: OCRRequest):
+async def perform_ocr(request_data: OCRRequest, background_tasks: BackgroundTasks):
     try:
         base64_image1 = request_data.base64Image1
         base64_image2 = request_data.base64Image2
 
-        if "," in base64_image1:
-            base64_image1 = base64_image1.split(',')[1]
+        # OpenAI gets the data URL, Apps Script gets the raw base64.
+        image1_data_url, base64_image1 = split_image_input(base64_image1)
         
-        base64_image2_cleaned = ""
+        image2_data_url, base64_image2_cleaned = None, ""
         if base64_image2:
-            if "," in base64_image2:
-                base64_image2_cleaned = base64_image2.split(',')[1]
-            else:
-                base64_image2_cleaned = base64_image2
+            image2_data_url, base64_image2_cleaned = split_image_input(base64_image2)
+
+        check_image_size(base64_image1, "base64Image1")
+        image1_bytes = decode_base64_image(base64_image1, "base64Image1")
+        if base64_image2_cleaned:
+            check_image_size(base64_image2_cleaned, "base64Image2")
+            image2_bytes = decode_base64_image(base64_image2_cleaned, "base64Image2")
+
+        # Resizing is CPU-bound, so keep it off the event loop.
+        image1_data_url = await asyncio.to_thread(downscale_for_vision, image1_bytes, base64_image1, image1_data_url, "base64Image1")
+        if base64_image2_cleaned:
+            image2_data_url = await asyncio.to_thread(downscale_for_vision, image2_bytes, base64_image2_cleaned, image2_data_url, "base64Image2")
 
         # === AI STEP 1: Extract data from image ===
         logger.info("Step 1: Sending image(s) to OpenAI for extraction...")
@@ -127,26 +314,30 @@ async def perform_ocr(request_data: OCRRequest):
         **Pay extremely close attention to stylized logos, gradients, shadows, or complex animations.** Use context (like slogans or other text) to determine the most likely correct spelling.
         Return the data as a clean JSON object with the following keys:
         'company', 'name', 'title', 'phone', 'email', 'address', 'slogan', 'location'
-        If a piece of information is not found, return an empty string for that key."""
+        If a piece of information is not found, return an empty string for that key.
+        Respond with a JSON object only."""
         
+        # Images are sent inline exactly once: this is the only vision call, and Chat
+        # Completions does not accept uploaded file ids for image inputs.
         image_list_content = [{"type": "text", "text": extract_prompt}]
-        image_list_content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image1}"}})
+        image_list_content.append({"type": "image_url", "image_url": {"url": image1_data_url}})
         if base64_image2_cleaned:
             logger.info("Processing front and back images.")
-            image_list_content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image2_cleaned}"}})
+            image_list_content.append({"type": "image_url", "image_url": {"url": image2_data_url}})
         else:
              logger.info("Processing front image only.")
 
-        extract_response = openai.chat.completions.create(
+        extract_response = await create_chat_completion(
             model="gpt-4o", 
             messages=[{"role": "user", "content": image_list_content }],
-            max_tokens=500
+            max_tokens=500,
+            response_format={"type": "json_object"}
         )
         ocr_data_str = extract_response.choices[0].message.content
-        ocr_data = parse_openai_json(ocr_data_str)
+        ocr_data = orjson.loads(ocr_data_str)
         logger.info(f"Step 1: Received from OpenAI: {ocr_data}")
 
-        # === Step 2: Google Search for VALIDATION (Unchanged) ===
+        # === Step 2: Google Searches for VALIDATION and ENRICHMENT ===
         search_query = ""
         company = ocr_data.get("company", "")
         name = ocr_data.get("name", "")
@@ -161,102 +352,58 @@ async def perform_ocr(request_data: OCRRequest):
             search_query = slogan
         elif name:
             search_query = name
-        google_results_list = None
-        if search_query:
-            logger.info(f"Step 2: Performing validation search for: {search_query}")
-            google_results_list = search_google(search_query, num_results=3)
+        contact_query = build_contact_query(company) if company else ""
+
+        logger.info(f"Step 2: Performing validation search for: {search_query!r} and enrichment search for: {contact_query!r}")
+        google_results_list, enrichment_search_results = await asyncio.gather(
+            maybe_search_google(search_query), maybe_search_google(contact_query)
+        )
 
-        # === AI STEP 3: Validate and FIRST Enrichment (Unchanged) ===
-        logger.info("Step 3: Sending data to OpenAI for validation and first enrichment...")
+        # === AI STEP 3: Validate, Correct and Enrich in one call ===
+        logger.info("Step 3: Sending data to OpenAI for validation and enrichment...")
         validation_prompt = f"""
-        You are a data validation expert. I have OCR data and a list of Google results.
-        Your job is to find the **single best match** from the results and use it to **correct** the OCR data.
-        Here is the data from OCR: {json.dumps(ocr_data)}
-        Here is the list of top 3 Google search results: {json.dumps(google_results_list) if google_results_list else "No results found."}
-        **Instructions:**
+        You are a data validation and enrichment expert. I have OCR data from a business card and two lists of Google results.
+        Here is the data from OCR: {orjson.dumps(ocr_data).decode()}
+        Here is the list of top 3 Google *validation* search results: {orjson.dumps(google_results_list).decode() if google_results_list else "No results found."}
+        Here is the list of results from the *enrichment* search for the company's details: {orjson.dumps(enrichment_search_results).decode() if enrichment_search_results else "No results found."}
+        **Part A - Validation (use only the validation results):**
         1.  **Find Best Match:** Find the one result (e.g., a company website or LinkedIn) that is the most likely match.
         2.  **If a Genuine Match is Found:**
             - Set 'is_validated' to true.
             - **Correct Data:** Correct any misspellings in the OCR 'company' or 'name' using the Google result.
             - **Enrich Website:** Fill in the 'website' field using the Google 'link'.
             - **Set 'validation_source' to the Google 'link'.**
-            - **Return all other OCR fields as-is** (we will search for more in the next step).
         3.  **If NO Genuine Match is Found:**
             - Set 'is_validated' to false.
-            - Return *only* the original OCR data.
-        Return a single, final JSON object with all keys from the OCR data, plus 'website', 'validation_source', 'is_validated'.
+            - Return *only* the original OCR data and skip Part B.
+        **Part B - Enrichment (only if 'is_validated' is true):**
+        1.  **Review Snippets Carefully:** Look through the 'snippet' and 'title' of **all** enrichment results. Ignore results that are not about the validated company.
+        2.  **Extract Key Details:**
+            * `about_the_company`: Find a concise (1-2 sentence) description of what the company does.
+            * `location`: Find the city, state, or general region mentioned. If an address exists, extract the city/state from it.
+            * `phone`, `email`, `address`: Find the first credible contact details.
+        3.  **Fill Empty Fields:** Use these details to fill ONLY the fields that are currently empty or contain just placeholder text.
+        4.  **Prioritize:** If multiple sources provide information for the same empty field, prioritize the most official-looking source (e.g., the company's own website snippet over a directory listing).
+        5.  **Do not overwrite** data that already exists unless the existing data is clearly wrong or a placeholder. Keep `validation_source` as set in Part A.
+        Return a single, final JSON object with all keys from the OCR data, plus 'website', 'validation_source', 'is_validated', 'about_the_company' and 'location'.
         """
-        validate_response = openai.chat.completions.create(
-            model="gpt-4o",
+        # Text-only merge over small JSON blobs; the mini model is enough here.
+        validate_response = await create_chat_completion(
+            model="gpt-4o-mini",
             messages=[{"role": "user", "content": validation_prompt}],
             response_format={"type": "json_object"}
         )
-        validated_data_str = validate_response.choices[0].message.content
-        validated_data = json.loads(validated_data_str)
-        logger.info(f"Step 3: Received validated data: {validated_data}")
-
-        # === STEP 4: Targeted Search for ENRICHMENT ===
-        enrichment_search_results = None
-        if validated_data.get("is_validated"):
-            validated_company = validated_data.get("company")
-            # --- [SLIGHTLY UPDATED QUERY] ---
-            contact_query = f'"{validated_company}" about description location contact info email phone address'
-            # --- [END OF UPDATE] ---
-            logger.info(f"Step 4: Performing targeted enrichment search for: {contact_query}")
-            enrichment_search_results = search_google(contact_query, num_results=3)
-        else:
-            logger.info("Step 4: Skipping enrichment search (validation failed).")
-
-        # === STEP 5: Final Merge and Enrichment ===
-        if enrichment_search_results:
-            logger.info("Step 5: Sending data to OpenAI for final merge...")
-            # --- [UPDATED PROMPT FOR RELIABILITY] ---
-            final_merge_prompt = f"""
-            You are a data enrichment assistant. I have partially validated data from a business card.
-            I have performed a *second* Google search to find missing company details like 'about', 'location', and contact info.
-            Your job is to merge this new information reliably.
-
-            Here is the data we have so far (after Step 3 validation):
-            {json.dumps(validated_data)}
-
-            Here is the list of results from the *new* enrichment search:
-            {json.dumps(enrichment_search_results)}
-
-            **Instructions:**
-            1.  **Review Snippets Carefully:** Look through the 'snippet' and 'title' of **all** search results.
-            2.  **Extract Key Details:**
-                * `about_the_company`: Find a concise (1-2 sentence) description of what the company does.
-                * `location`: Find the city, state, or general region mentioned. If an address exists, extract the city/state from it.
-                * `phone`, `email`, `address`: Find the first credible contact details.
-            3.  **Merge Data:** Return a final JSON object. Use the data from "data we have so far" as the base.
-            4.  **Fill Empty Fields:** Use the details extracted in step 2 to fill ONLY the fields that are currently empty or contain just placeholder text.
-            5.  **Prioritize:** If multiple sources provide information for the same empty field, prioritize the most official-looking source (e.g., the company's own website snippet over a directory listing).
-            6.  **Do not overwrite** data that already exists unless the existing data is clearly wrong or a placeholder. Keep `validation_source` as it is.
-
-            Return a single, final JSON object including 'about_the_company' and 'location'.
-            """
-            # --- [END OF UPDATE] ---
-            
-            final_response = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": final_merge_prompt}],
-                response_format={"type": "json_object"}
-            )
-            final_data_str = final_response.choices[0].message.content
-            final_data = json.loads(final_data_str)
-            logger.info(f"Step 5: Received final merged data: {final_data}")
-        else:
-            logger.info("Step 5: No final merge needed.")
-            final_data = validated_data
+        final_data_str = validate_response.choices[0].message.content
+        final_data = orjson.loads(final_data_str)
+        logger.info(f"Step 3: Received validated and enriched data: {final_data}")
         
-        phone_number = final_data.get("phone", "")
-        if phone_number and phone_number.startswith('+'):
+        phone_number = final_data.get("phone") or ""
+        if phone_number[:1] == '+':
             final_data["phone"] = "'" + phone_number
-        if 'slogan' in final_data:
-            del final_data['slogan']
+        final_data.pop('slogan', None)
 
-        # === STEP 6: Submit to Google Apps Script (Unchanged) ===
-        logger.info(f"Step 6: Submitting final data to Google Apps Script...")
+        # === STEP 4: Submit to Google Apps Script (in the background) ===
+        logger.info("Step 4: Queueing final data for Google Apps Script...")
         
         apps_script_payload = {
             "action": "save",
@@ -265,25 +412,9 @@ async def perform_ocr(request_data: OCRRequest):
             "extractedData": final_data
         }
 
-        try:
-            headers = {'Content-Type': 'text/plain;charset=utf-8'}
-            response = requests.post(
-                APPS_SCRIPT_URL,
-                data=json.dumps(apps_script_payload),
-                headers=headers
-            )
-            response.raise_for_status()
-            save_result = response.json()
-            if not save_result.get("success"):
-                logger.error(f"Google Apps Script failed to save: {save_result.get('message')}")
-                raise HTTPException(status_code=500, detail=f"Google Script Error: {save_result.get('message')}")
-            logger.info("Step 6: Successfully submitted to Google Apps Script.")
-        
-        except Exception as e:
-            logger.error(f"Failed to submit to Google Apps Script: {e}", exc_info=True)
-            raise HTTPException(status_code=502, detail=f"Apps Script Submission Failed: {e}")
+        background_tasks.add_task(_submit_to_apps_script, apps_script_payload)
 
-        return OCRResponse(**final_data)
+        return OCRResponse.model_validate(final_data)
 
     except Exception as e:
         logger.error(f"An error occurred during processing: {e}", exc_info=True)
@@ -296,4 +427,13 @@ def status_check():
     return Response(status_code=200)
 
 if __name__ == "__main__":
-    print("Starting FastAPI server. Run with: uvicorn main:app --host 0.0.0.0 --port 8000")
+    # Same worker default as the Dockerfile; WEB_CONCURRENCY sets the worker count.
+    # "auto" picks uvloop/httptools when installed (not on Windows).
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", "4")),
+        loop="auto",
+        http="auto",
+    )